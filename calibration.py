@@ -1,45 +1,201 @@
 from machine import I2C, Pin
+import array
+import micropython
 import time
 import math
 import struct
 
 
+@micropython.viper
+def _minmax(a: ptr16, n: int, out: ptr32):
+    """Store min and max of n int16 values from a into out[0] and out[1], n must be > 0."""
+    # ptr16 loads are unsigned, sign-extend to int16
+    mn = (int(a[0]) ^ 0x8000) - 0x8000
+    mx = mn
+    i = 1
+    while i < n:
+        v = (int(a[i]) ^ 0x8000) - 0x8000
+        if v < mn:
+            mn = v
+        elif v > mx:
+            mx = v
+        i += 1
+    out[0] = mn
+    out[1] = mx
+
+
+def _cholesky(a):
+    """Lower triangular factor of symmetric positive definite a, None if a is not positive definite."""
+    n = len(a)
+    low = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(i + 1):
+            acc = a[i][j] - sum(low[i][k] * low[j][k] for k in range(j))
+            if i == j:
+                if acc <= 0:
+                    return None
+                low[i][i] = math.sqrt(acc)
+            else:
+                low[i][j] = acc / low[j][j]
+    return low
+
+
+def _cholesky_solve(low, b):
+    """Solve a * x = b given the Cholesky factor low of a."""
+    n = len(b)
+    # Forward substitution low * y = b, then back substitution low^T * x = y
+    y = [0.0] * n
+    for i in range(n):
+        y[i] = (b[i] - sum(low[i][k] * y[k] for k in range(i))) / low[i][i]
+    x = [0.0] * n
+    for i in range(n - 1, -1, -1):
+        x[i] = (y[i] - sum(low[k][i] * x[k] for k in range(i + 1, n))) / low[i][i]
+    return x
+
+
+# Largest accepted standard error of a fitted parameter, relative to the axis radius.
+_MAX_REL_STDERR = 0.1
+
+
+def _fit_ellipsoid(xs, ys, zs, center, radii, iterations=20):
+    """Fit an axis aligned ellipsoid to the samples with Gauss-Newton.
+
+    Model is (kx*(x-bx))^2 + (ky*(y-by))^2 + (kz*(z-bz))^2 = 1 with center b
+    and inverse radii k. center and radii are the initial guess (bounding box).
+    Returns fitted (center, radii), or None if the solve fails, the residual grows,
+    the fit does not converge within iterations or a parameter is not constrained
+    by the samples.
+    """
+    if radii[0] <= 0 or radii[1] <= 0 or radii[2] <= 0:
+        return None
+
+    # Scale points around the initial guess so all parameters are close to 0 or 1
+    cx, cy, cz = center
+    scale = (radii[0] + radii[1] + radii[2]) / 3
+    inv_scale = 1 / scale
+    params = [0.0, 0.0, 0.0, scale / radii[0], scale / radii[1], scale / radii[2]]
+    n = len(xs)
+    prev_cost = None
+
+    for _ in range(iterations):
+        bx, by, bz, kx, ky, kz = params
+        jtj = [[0.0] * 6 for _ in range(6)]
+        jtr = [0.0] * 6
+        cost = 0.0
+
+        for i in range(n):
+            u = (xs[i] - cx) * inv_scale - bx
+            v = (ys[i] - cy) * inv_scale - by
+            w = (zs[i] - cz) * inv_scale - bz
+            ku = kx * u
+            kv = ky * v
+            kw = kz * w
+            r = ku * ku + kv * kv + kw * kw - 1
+            cost += r * r
+            # Partial derivatives of r over bx, by, bz, kx, ky, kz
+            jac = (-2 * kx * ku, -2 * ky * kv, -2 * kz * kw, 2 * ku * u, 2 * kv * v, 2 * kw * w)
+            for a in range(6):
+                ja = jac[a]
+                row = jtj[a]
+                jtr[a] += ja * r
+                for b in range(a, 6):
+                    row[b] += ja * jac[b]
+
+        # Gauss-Newton should only decrease the residual, growth means it diverges
+        if prev_cost is not None and cost > prev_cost * (1 + 1e-9):
+            return None
+        prev_cost = cost
+
+        for a in range(6):
+            for b in range(a):
+                jtj[a][b] = jtj[b][a]
+
+        low = _cholesky(jtj)
+        if low is None:
+            return None
+        delta = _cholesky_solve(low, [-g for g in jtr])
+        params = [params[k] + delta[k] for k in range(6)]
+        # Scaled units, 1e-4 is well below one raw count
+        if max(abs(d) for d in delta) < 1e-4:
+            break
+    else:
+        # Not converged
+        return None
+
+    bx, by, bz, kx, ky, kz = params
+    if kx <= 0 or ky <= 0 or kz <= 0:
+        return None
+
+    # Standard errors from the parameter covariance sigma^2 * (J^T J)^-1. An axis the
+    # samples do not constrain (e.g. flat rotation) has a large error relative to its radius.
+    sigma2 = cost / (n - 6) if n > 6 else 0.0
+    for j in range(6):
+        unit = [0.0] * 6
+        unit[j] = 1.0
+        se = math.sqrt(sigma2 * _cholesky_solve(low, unit)[j])
+        # Center error relative to the radius, inverse radius error relative to itself
+        k = params[3 + j % 3]
+        rel = se * k if j < 3 else se / k
+        if rel > _MAX_REL_STDERR:
+            return None
+
+    return ((cx + bx * scale, cy + by * scale, cz + bz * scale),
+            (scale / kx, scale / ky, scale / kz))
+
+
 class QMC5883L:
     def __init__(self, i2c, addr=0x0D):
         self.i2c = i2c
         self.addr = addr
+        self._buf = bytearray(6)  # Reused for every X, Y, Z read to avoid allocations
+        self._status = bytearray(1)  # Reused for status register (DRDY) polling
 
         # Initialize the sensor
         self.i2c.writeto_mem(self.addr, 0x0B, b'\x01')  # Set to Standby mode
         self.i2c.writeto_mem(self.addr, 0x09, b'\x1D')  # Set register 0x09 (OSR = 512, RNG = 8G, ODR = 200Hz, MODE = Continuous)
         time.sleep(0.1)
 
-        # Calibration parameters - hard iron (offsets)
-        self.offset_x = 0
-        self.offset_y = 0
-        self.offset_z = 0
+        # Calibration parameters - hard iron (offsets x, y, z)
+        self._off = (0, 0, 0)
 
-        # Calibration parameters - soft iron (transformation matrix)
+        # Calibration parameters - soft iron (transformation matrix, flat row-major)
         # Default to identity matrix
-        self.transform_matrix = [
-            [1.0, 0.0, 0.0],
-            [0.0, 1.0, 0.0],
-            [0.0, 0.0, 1.0]
-        ]
+        self._m = (1.0, 0.0, 0.0,
+                   0.0, 1.0, 0.0,
+                   0.0, 0.0, 1.0)
+
+    @property
+    def offset_x(self):
+        return self._off[0]
+
+    @property
+    def offset_y(self):
+        return self._off[1]
+
+    @property
+    def offset_z(self):
+        return self._off[2]
+
+    @property
+    def transform_matrix(self):
+        """Soft iron matrix as nested lists, the format QMC5883L in gy271compass.py expects."""
+        m = self._m
+        return [list(m[0:3]), list(m[3:6]), list(m[6:9])]
 
     def read_raw_data(self):
         """Read raw magnetometer data."""
-        data = self.i2c.readfrom_mem(self.addr, 0x00, 6)
-        x = data[0] | (data[1] << 8)
-        if x > 32767:
-            x -= 65536
-        y = data[2] | (data[3] << 8)
-        if y > 32767:
-            y -= 65536
-        z = data[4] | (data[5] << 8)
-        if z > 32767:
-            z -= 65536
-        return x, y, z
+        self.i2c.readfrom_mem_into(self.addr, 0x00, self._buf)
+        return struct.unpack("<hhh", self._buf)
+
+    def wait_data_ready(self, timeout_ms=100):
+        """Poll the status register until DRDY signals a new sample, OSError on timeout."""
+        deadline = time.ticks_add(time.ticks_ms(), timeout_ms)
+        while True:
+            self.i2c.readfrom_mem_into(self.addr, 0x06, self._status)
+            if self._status[0] & 0x01:
+                return
+            if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                raise OSError(f"No new data from QMC5883L within {timeout_ms}ms, check sensor mode")
 
     def read_calibrated_data(self):
         """Read and apply calibration to data."""
@@ -47,68 +203,72 @@ class QMC5883L:
         x, y, z = self.read_raw_data()
 
         # Apply hard iron correction (offset)
-        x_offset = x - self.offset_x
-        y_offset = y - self.offset_y
-        z_offset = z - self.offset_z
+        ox, oy, oz = self._off
+        x -= ox
+        y -= oy
+        z -= oz
 
         # Apply soft iron correction (transformation matrix)
-        x_cal = (self.transform_matrix[0][0] * x_offset +
-                 self.transform_matrix[0][1] * y_offset +
-                 self.transform_matrix[0][2] * z_offset)
-
-        y_cal = (self.transform_matrix[1][0] * x_offset +
-                 self.transform_matrix[1][1] * y_offset +
-                 self.transform_matrix[1][2] * z_offset)
-
-        z_cal = (self.transform_matrix[2][0] * x_offset +
-                 self.transform_matrix[2][1] * y_offset +
-                 self.transform_matrix[2][2] * z_offset)
-
-        return x_cal, y_cal, z_cal
-
-    def collect_calibration_data(self, samples=20000, delay_ms=10):
-        """Collect data points for calibration by rotating sensor in all directions."""
+        m00, m01, m02, m10, m11, m12, m20, m21, m22 = self._m
+        return (m00 * x + m01 * y + m02 * z,
+                m10 * x + m11 * y + m12 * z,
+                m20 * x + m21 * y + m22 * z)
+
+    def collect_calibration_data(self, samples=500, delay_ms=50):
+        """Collect data points for calibration by rotating sensor in all directions.
+
+        Samples are read as soon as DRDY is set, delay_ms paces them so the default
+        500 samples span about 25 s of rotation.
+        Returns three int16 arrays (xs, ys, zs), 6 bytes per sample.
+        """
         print("\nBegin collecting calibration data...")
         print("Rotate the sensor slowly in all directions to cover all possible orientations.")
         print(f"Collecting {samples} samples...")
 
-        data_points = []
+        xs = array.array('h', bytearray(2 * samples))
+        ys = array.array('h', bytearray(2 * samples))
+        zs = array.array('h', bytearray(2 * samples))
 
         for i in range(samples):
-            x, y, z = self.read_raw_data()
-            data_points.append((x, y, z))
+            self.wait_data_ready()
+            xs[i], ys[i], zs[i] = self.read_raw_data()
 
             if i % 100 == 0:
                 print(f"Progress: {i / samples * 100:.1f}%")
 
-            time.sleep_ms(delay_ms)
+            if delay_ms:
+                time.sleep_ms(delay_ms)
 
         print("Data collection complete!")
-        return data_points
+        return xs, ys, zs
 
-    def calculate_calibration_parameters(self, data_points):
+    def calculate_calibration_parameters(self, xs, ys, zs):
         """Calculate calibration parameters from collected data."""
-        # Hard iron correction: find the center of the ellipsoid
-        min_x = min_y = min_z = 32767
-        max_x = max_y = max_z = -32768
-
-        for x, y, z in data_points:
-            min_x = min(min_x, x)
-            max_x = max(max_x, x)
-            min_y = min(min_y, y)
-            max_y = max(max_y, y)
-            min_z = min(min_z, z)
-            max_z = max(max_z, z)
-
-        # Calculate offsets (center of ellipsoid)
-        self.offset_x = (min_x + max_x) // 2
-        self.offset_y = (min_y + max_y) // 2
-        self.offset_z = (min_z + max_z) // 2
-
-        # Calculate average radii
-        radius_x = (max_x - min_x) / 2
-        radius_y = (max_y - min_y) / 2
-        radius_z = (max_z - min_z) / 2
+        n = len(xs)
+        if n == 0:
+            raise ValueError("No calibration samples collected")
+        out = array.array('i', (0, 0))
+        _minmax(xs, n, out)
+        min_x, max_x = out
+        _minmax(ys, n, out)
+        min_y, max_y = out
+        _minmax(zs, n, out)
+        min_z, max_z = out
+
+        # Bounding box is the initial guess for the ellipsoid fit
+        center = ((min_x + max_x) / 2, (min_y + max_y) / 2, (min_z + max_z) / 2)
+        radii = ((max_x - min_x) / 2, (max_y - min_y) / 2, (max_z - min_z) / 2)
+        fit = _fit_ellipsoid(xs, ys, zs, center, radii)
+        if fit:
+            center, radii = fit
+        else:
+            print("Ellipsoid fit failed, using min/max bounding box.")
+
+        # Hard iron correction: offsets are the center of the ellipsoid
+        self._off = (int(round(center[0])), int(round(center[1])), int(round(center[2])))
+
+        # Soft iron correction: ellipsoid radii
+        radius_x, radius_y, radius_z = radii
 
         # Calculate average radius
         avg_radius = (radius_x + radius_y + radius_z) / 3
@@ -118,13 +278,11 @@ class QMC5883L:
         scale_y = avg_radius / radius_y if radius_y > 0 else 1
         scale_z = avg_radius / radius_z if radius_z > 0 else 1
 
-        # Update transformation matrix for scaling (simple approach)
-        # For a more accurate approach, eigenvalue decomposition would be needed
-        self.transform_matrix = [
-            [scale_x, 0, 0],
-            [0, scale_y, 0],
-            [0, 0, scale_z]
-        ]
+        # Update transformation matrix for scaling (axis aligned ellipsoid)
+        # For a rotated ellipsoid, eigenvalue decomposition would be needed
+        self._m = (scale_x, 0.0, 0.0,
+                   0.0, scale_y, 0.0,
+                   0.0, 0.0, scale_z)
 
         return {
             'offset_x': self.offset_x,
@@ -136,15 +294,15 @@ class QMC5883L:
             'transform_matrix': self.transform_matrix
         }
 
-    def advanced_calibrate(self, samples=20000, delay_ms=10):
+    def advanced_calibrate(self, samples=500, delay_ms=50):
         """Perform advanced calibration of the magnetometer."""
         print("Starting advanced calibration...")
 
         # Collect calibration data
-        data_points = self.collect_calibration_data(samples, delay_ms)
+        xs, ys, zs = self.collect_calibration_data(samples, delay_ms)
 
         # Calculate calibration parameters
-        cal_params = self.calculate_calibration_parameters(data_points)
+        cal_params = self.calculate_calibration_parameters(xs, ys, zs)
 
         print("\nCalibration Complete!")
         print(f"Hard Iron Offsets: X={self.offset_x}, Y={self.offset_y}, Z={self.offset_z}")
@@ -156,16 +314,9 @@ class QMC5883L:
     def save_calibration(self, filename='mag_calibration.dat'):
         """Save calibration parameters to a file."""
         try:
+            # Format: offset_x, offset_y, offset_z, followed by 9 transform matrix values
+            data = struct.pack("<iii9f", *(self._off + self._m))
             with open(filename, 'wb') as f:
-                # Format: offset_x, offset_y, offset_z, followed by 9 transform matrix values
-                data = struct.pack("<iii9f",
-                                   self.offset_x, self.offset_y, self.offset_z,
-                                   self.transform_matrix[0][0], self.transform_matrix[0][1],
-                                   self.transform_matrix[0][2],
-                                   self.transform_matrix[1][0], self.transform_matrix[1][1],
-                                   self.transform_matrix[1][2],
-                                   self.transform_matrix[2][0], self.transform_matrix[2][1], self.transform_matrix[2][2]
-                                   )
                 f.write(data)
             print(f"Calibration saved to {filename}")
             return True
@@ -182,17 +333,9 @@ class QMC5883L:
             # Unpack the data
             values = struct.unpack("<iii9f", data)
 
-            # Set offsets
-            self.offset_x = values[0]
-            self.offset_y = values[1]
-            self.offset_z = values[2]
-
-            # Set transform matrix
-            self.transform_matrix = [
-                [values[3], values[4], values[5]],
-                [values[6], values[7], values[8]],
-                [values[9], values[10], values[11]]
-            ]
+            # Set offsets and transform matrix
+            self._off = values[0:3]
+            self._m = values[3:12]
 
             print(f"Calibration loaded from {filename}")
             print(f"Hard Iron Offsets: X={self.offset_x}, Y={self.offset_y}, Z={self.offset_z}")
@@ -235,8 +378,8 @@ def visualize_calibration(mag, num_samples=200):
         cal_x, cal_y, cal_z = mag.read_calibrated_data()
 
         # Calculate magnitudes
-        raw_mag = math.sqrt(raw_x ** 2 + raw_y ** 2 + raw_z ** 2)
-        cal_mag = math.sqrt(cal_x ** 2 + cal_y ** 2 + cal_z ** 2)
+        raw_mag = math.sqrt(raw_x * raw_x + raw_y * raw_y + raw_z * raw_z)
+        cal_mag = math.sqrt(cal_x * cal_x + cal_y * cal_y + cal_z * cal_z)
 
         if i % 20 == 0:
             print(f"Raw: ({raw_x}, {raw_y}, {raw_z}) Mag: {raw_mag:.1f}")
@@ -249,8 +392,8 @@ def visualize_calibration(mag, num_samples=200):
 
 
 def main():
-    # Setup I2C
-    i2c = I2C(0, scl=Pin(22), sda=Pin(21), freq=100000)
+    # Setup I2C, QMC5883L supports fast mode (400kHz)
+    i2c = I2C(0, scl=Pin(22), sda=Pin(21), freq=400000)
 
     # Initialize sensor
     qmc = QMC5883L(i2c)
@@ -268,7 +411,7 @@ def main():
 
         if choice == '1':
             # Perform calibration
-            cal_params = qmc.advanced_calibrate(samples=1000, delay_ms=50)
+            cal_params = qmc.advanced_calibrate()
 
             # Save calibration
             qmc.save_calibration()
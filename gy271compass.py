@@ -1,8 +1,22 @@
 import math
+import struct
 import time
 
 from machine import I2C
 
+# Hoisted constants for the heading path, avoids math.pi lookups on every call.
+_TWO_PI = 2 * math.pi
+_RAD2DEG = 180.0 / math.pi
+_atan2 = math.atan2
+
+# Compass directions in 45 degree sectors, starting at north.
+_DIRECTIONS = ("N", "NE", "E", "SE", "S", "SW", "W", "NW")
+_DIR_SCALE = 8.0 / 360.0
+
+# Fixed point scale (Q12) for soft iron X/Y factors in the heading path, relative to the larger factor.
+# 16-bit axis * factor up to 1.0 in Q12 stays within MicroPython small int range (no heap allocation).
+_Q = 4096
+
 
 class QMC5883L:
     # QMC5883L (GY-271) register addresses.
@@ -21,9 +35,6 @@ class QMC5883L:
     REG_CONTROL2 = 0x0A
     REG_SET_RESET = 0x0B
 
-    _16_bit_value_max = 65536
-    _16_bit_value_half = 32767
-
     def __init__(self, i2c: I2C,
                  address: int = None,
                  calibration_offsets: tuple = None,
@@ -40,14 +51,29 @@ class QMC5883L:
         """
         self.i2c = i2c
         self.address = address if address else 0x0D     # Typical QMC5883L address.
+        self._buf = bytearray(6)    # Reused for every X, Y, Z read to avoid allocations.
+        self._status = bytearray(1)     # Reused for status register (DRDY) reads.
 
+        # Calibration is kept as flat tuples, unpacked to locals in the read path.
         # Calibration parameters - hard iron (offsets)
         # Example (-2364, -496, 68)
-        self.offset_x, self.offset_y, self.offset_z = calibration_offsets
+        self._off = tuple(calibration_offsets)
 
-        # Calibration parameters - soft iron (transformation matrix)
+        # Calibration parameters - soft iron (transformation matrix), flattened row-major
         # Example [[1.118951, 0.0, 0.0], [0.0, 1.07733, 0.0], [0.0, 0.0, 0.8488354]])
-        self.transform_matrix = calibration_transform_matrix
+        self._m = tuple(calibration_transform_matrix[i][j] for i in range(3) for j in range(3))
+
+        # Diagonal matrix (scale only) allows a fast path with 3 multiplications instead of 9.
+        m00, m01, m02, m10, m11, m12, m20, m21, m22 = self._m
+        if m01 == m02 == m10 == m12 == m20 == m21 == 0:
+            self._diag = (m00, m11, m22)
+            # Only the X/Y ratio matters for heading, normalize so the larger factor is 1.0.
+            k = max(abs(m00), abs(m11))
+            k = _Q / k if k else 0
+            self._diag_q = (round(m00 * k), round(m11 * k))
+        else:
+            self._diag = None
+            self._diag_q = None
 
         # Soft reset
         self.i2c.writeto_mem(self.address, self.REG_CONTROL2, bytes([0b10000000]))
@@ -61,77 +87,104 @@ class QMC5883L:
         self.i2c.writeto_mem(self.address, self.REG_SET_RESET, bytes([0b00000001]))
         time.sleep(0.1)
 
+    @property
+    def offset_x(self) -> int:
+        return self._off[0]
+
+    @property
+    def offset_y(self) -> int:
+        return self._off[1]
+
+    @property
+    def offset_z(self) -> int:
+        return self._off[2]
+
+    @property
+    def transform_matrix(self) -> list:
+        """Soft iron matrix as nested lists, as passed to __init__."""
+        m = self._m
+        return [list(m[0:3]), list(m[3:6]), list(m[6:9])]
+
+    def data_ready(self) -> bool:
+        """Check DRDY bit, True when a new X, Y, Z sample is available."""
+        self.i2c.readfrom_mem_into(self.address, self.REG_STATUS, self._status)
+        return bool(self._status[0] & 0x01)
+
     def read_raw_data(self) -> tuple:
-        # Read 6 bytes of data from register(0x00)
-        try:
-            data = self.i2c.readfrom_mem(self.address, self.REG_XOUT_LSB, 6)
-            # Convert the data to signed 16-bit values
-            x = data[0] | (data[1] << 8)
-            if x > self._16_bit_value_half:
-                x -= self._16_bit_value_max
-
-            y = data[2] | (data[3] << 8)
-            if y > self._16_bit_value_half:
-                y -= self._16_bit_value_max
-
-            z = data[4] | (data[5] << 8)
-            if z > self._16_bit_value_half:
-                z -= self._16_bit_value_max
-
-            return x, y, z
-        except Exception as e:
-            print(f"Error reading compass data: {e}")
-            return None, None, None
+        # Read 6 bytes of data from register(0x00), I2C errors (OSError) are raised to the caller.
+        self.i2c.readfrom_mem_into(self.address, self.REG_XOUT_LSB, self._buf)
+        # Convert the data to signed 16-bit little endian values
+        return struct.unpack("<hhh", self._buf)
 
     def read_calibrated_data(self) -> tuple:
         """Read and apply calibration to data."""
         # Get raw data
         x, y, z = self.read_raw_data()
 
-        if x and y and z:
-            # Apply hard iron correction (offset)
-            x_offset = x - self.offset_x
-            y_offset = y - self.offset_y
-            z_offset = z - self.offset_z
+        ox, oy, oz = self._off
+        if self._diag:
+            sx, sy, sz = self._diag
+            return sx * (x - ox), sy * (y - oy), sz * (z - oz)
 
-            # Apply soft iron correction (transformation matrix)
-            x_cal = (self.transform_matrix[0][0] * x_offset +
-                     self.transform_matrix[0][1] * y_offset +
-                     self.transform_matrix[0][2] * z_offset)
+        # Apply hard iron correction (offset)
+        x -= ox
+        y -= oy
+        z -= oz
 
-            y_cal = (self.transform_matrix[1][0] * x_offset +
-                     self.transform_matrix[1][1] * y_offset +
-                     self.transform_matrix[1][2] * z_offset)
+        # Apply soft iron correction (transformation matrix)
+        m00, m01, m02, m10, m11, m12, m20, m21, m22 = self._m
+        return (m00 * x + m01 * y + m02 * z,
+                m10 * x + m11 * y + m12 * z,
+                m20 * x + m21 * y + m22 * z)
 
-            z_cal = (self.transform_matrix[2][0] * x_offset +
-                     self.transform_matrix[2][1] * y_offset +
-                     self.transform_matrix[2][2] * z_offset)
+    def _read_xy(self) -> tuple:
+        """
+        Read and apply calibration to X and Y only, as needed for heading.
+        Diagonal calibration returns scaled fixed point ints, only the X/Y ratio is meaningful.
+        """
+        x, y, z = self.read_raw_data()
 
-            return x_cal, y_cal, z_cal
-        return None, None, None
+        ox, oy, oz = self._off
+        if self._diag_q:
+            sx_q, sy_q = self._diag_q
+            return (x - ox) * sx_q, (y - oy) * sy_q
 
-    def get_heading(self) -> float | None:
-        x, y, z = self.read_calibrated_data()
+        x -= ox
+        y -= oy
+        z -= oz
+        m00, m01, m02, m10, m11, m12, _, _, _ = self._m
+        return (m00 * x + m01 * y + m02 * z,
+                m10 * x + m11 * y + m12 * z)
 
-        if x and y:
-            # Calculate heading in degrees
-            heading = math.atan2(y, x)
+    @staticmethod
+    def _heading(x, y) -> float:
+        # Calculate heading in degrees
+        heading = _atan2(y, x)
+
+        # Correct for when signs are reversed.
+        if heading < 0:
+            heading += _TWO_PI
 
-            # Correct for when signs are reversed.
-            if heading < 0:
-                heading += 2 * math.pi
+        # Check for wrap due to addition of declination.
+        if heading > _TWO_PI:
+            heading -= _TWO_PI
 
-            # Check for wrap due to addition of declination.
-            if heading > 2 * math.pi:
-                heading -= 2 * math.pi
+        # Convert radians to degrees.
+        heading_degrees = heading * _RAD2DEG
 
-            # Convert radians to degrees.
-            heading_degrees = heading * 180 / math.pi
+        return heading_degrees
 
-            return heading_degrees
-        return None
+    def get_heading(self) -> float:
+        x, y = self._read_xy()
+        return self._heading(x, y)
+
+    def read_and_heading(self) -> tuple:
+        """Calibrated x, y, z and heading in degrees from a single sensor read."""
+        x, y, z = self.read_calibrated_data()
+        return x, y, z, self._heading(x, y)
 
     @staticmethod
     def get_direction(angle_degrees) -> str:
-        directions = ["N", "NE", "E", "SE", "S", "SW", "W", "NW", "N"]
-        return directions[round(angle_degrees / 45) % 8]
+        """Compass direction for angle_degrees, valid for angles from -360."""
+        # Offset by a full turn (8 sectors) keeps the value positive, so int() acts as floor.
+        return _DIRECTIONS[int(angle_degrees * _DIR_SCALE + 8.5) & 7]
@@ -19,13 +19,17 @@ if __name__ == "__main__":
     while True:
         try:
             while True:
-                x, y, z = qmc.read_calibrated_data()
-                heading = qmc.get_heading()
-                if heading and abs(heading_precious - heading) > 2:
+                # Wait for a new sample (50Hz output rate) instead of a fixed delay.
+                if not qmc.data_ready():
+                    time.sleep_ms(5)
+                    continue
+                x, y, z, heading = qmc.read_and_heading()
+                if abs(heading_precious - heading) > 2:
                     heading_precious = heading
                     print(f"X={x:.1f}, Y={y:.1f}, Z={z:.1f}, Heading={heading:.1f}°")
-                time.sleep(0.05)
         except KeyboardInterrupt:
             print("\nStopped reading")
         except Exception as e:
             print(f"Error compass: {e}")
+            # Back off before retrying, e.g. sensor disconnected.
+            time.sleep_ms(100)